@@ -1,15 +1,21 @@
+import hashlib
 import logging
+import mmap
+import os
+import struct
+import sys
 from os import PathLike
 from pathlib import Path
 from concurrent.futures import Executor
 import asyncio
-from contextlib import AbstractAsyncContextManager, nullcontext
+from contextlib import AbstractAsyncContextManager, ExitStack, nullcontext
 
 import chws_tool
 import httpx
-from fontTools import ttLib
-from fontTools.varLib import instancer
-from nototools import font_data, tool_utils
+import uharfbuzz as hb
+from fontTools.ttLib import getSearchRange
+from fontTools.ttLib.sfnt import calcChecksum
+from nototools import tool_utils
 from tqdm import tqdm
 
 ## BEGIN: https://android.googlesource.com/platform/external/noto-fonts.git/+/refs/heads/android15-release/scripts/subset_noto_cjk.py
@@ -65,9 +71,24 @@ EXCLUDED_CODEPOINTS = frozenset(sorted(EMOJI_IN_CJK | ANDROID_EMOJI | CONTROL_CH
 
 ## END: https://android.googlesource.com/platform/external/noto-fonts.git/+/refs/heads/android15-release/scripts/subset_noto_cjk.py
 
+# hb-subset does the cmap pruning in C++, hand it a prebuilt set
+EXCLUDED_UNICODE_SET = hb.Set(EXCLUDED_CODEPOINTS)
+
 def ensure_parent_dir(path: PathLike):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
 
+def prefetch_file(path: PathLike):
+    """
+    Ask the kernel to start reading a file into the page cache ahead of use.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
 def process_ttf_worker(in_ttf, out_ttf, temp_dir):
     """
     Apply CHWS patch to a font file.
@@ -77,23 +98,45 @@ def process_ttf_worker(in_ttf, out_ttf, temp_dir):
     chws_output = Path(temp_dir) / "intermediate_chws" / Path(in_ttf).name
     ensure_parent_dir(chws_output)
     print(f"  ADD_CHWS\t{in_ttf}")
-    chws_tool.add_chws(in_ttf, chws_output)
+    # chws_tool only saves to a path and reads it back for its own shaping test,
+    # so this intermediate file has to stay; it returns None and writes nothing
+    # when the font needs no changes
+    chws_output = chws_tool.add_chws(in_ttf, chws_output) or in_ttf
 
     print(f"  SUBSET\t{chws_output}")
-    font = ttLib.TTFont(chws_output)
-    font_data.delete_from_cmap(font, EXCLUDED_CODEPOINTS)
+    # every face is subset exactly once, hb.subset_preprocess() would only cost
+    # an extra pass over it; keep the blob (a mapping of the file, not a copy)
+    # referenced for as long as the face
+    blob = hb.Blob.from_file_path(chws_output)
+    face = hb.Face(blob)
+    subset_input = hb.SubsetInput()
+    subset_input.keep_everything()
+    subset_input.flags |= hb.SubsetFlags.RETAIN_GIDS
+    # glyphs requested explicitly keep their cmap entries, so stop requesting the
+    # glyphs of excluded codepoints; unless still reachable from the remaining
+    # codepoints they are emptied in place (gids are retained), while unencoded
+    # glyphs such as GSUB-only alternates are kept as they were
+    font = hb.Font(face)
+    subset_input.glyph_set.difference_update(hb.Set(
+        gid for gid in map(font.get_nominal_glyph, EXCLUDED_CODEPOINTS) if gid is not None
+    ))
+    subset_input.unicode_set.difference_update(EXCLUDED_UNICODE_SET)
 
-    if 'fvar' in font:
-        # drop VORG from font as it is optional and not handled in fontTools.varLib.instancer (yet)
+    if 'fvar' in face.table_tags:
+        # drop VORG from font as it is optional and not instanced by hb-subset (yet)
         # ref: https://learn.microsoft.com/en-us/typography/opentype/spec/vorg
         print(f"  VFINST\t{chws_output}")
-        del font['VORG']
-        font['VVAR'].table.VOrgMap = None
-        instancer.instantiateVariableFont(font, {'wght':(100, 400, 900)}, inplace=True, updateFontNames=False)
+        subset_input.drop_table_tag_set.add(int.from_bytes(b'VORG', 'big'))
+        if not subset_input.set_axis_range(face, 'wght', 100, 900, 400):
+            raise ValueError(f"failed to set wght axis range of {chws_output}")
 
     print(f"  TTF\t{out_ttf}")
     ensure_parent_dir(out_ttf)
-    font.save(out_ttf)
+    Path(out_ttf).write_bytes(hb.subset(face, subset_input).blob.data)
+
+
+DOWNLOAD_WRITE_SIZE = 1 << 20
+PROGRESS_UPDATE_SIZE = 1 << 20
 
 
 async def download_file(
@@ -112,39 +155,195 @@ async def download_file(
                     unit="B",
                     unit_divisor=1024,
                     unit_scale=True,
+                    mininterval=0.5,
+                    # no progress bar at all when stderr is not a terminal (CI logs)
+                    disable=None,
                 ) as progress:
                     ensure_parent_dir(save_path_file_name)
                     with open(save_path_file_name, "wb") as f:
+                        buffer = bytearray()
+                        pending_write = None
                         num_bytes_downloaded = response.num_bytes_downloaded
-                        async for chunk in response.aiter_bytes():
-                            f.write(chunk)
-                            progress.update(
-                                response.num_bytes_downloaded - num_bytes_downloaded
-                            )
-                            num_bytes_downloaded = response.num_bytes_downloaded
+                        try:
+                            async for chunk in response.aiter_bytes():
+                                buffer += chunk
+                                if len(buffer) >= DOWNLOAD_WRITE_SIZE:
+                                    if pending_write is not None:
+                                        await pending_write
+                                    # write off the event loop and keep receiving into a new buffer
+                                    pending_write = asyncio.ensure_future(asyncio.to_thread(f.write, buffer))
+                                    buffer = bytearray()
+                                if response.num_bytes_downloaded - num_bytes_downloaded >= PROGRESS_UPDATE_SIZE:
+                                    progress.update(
+                                        response.num_bytes_downloaded - num_bytes_downloaded
+                                    )
+                                    num_bytes_downloaded = response.num_bytes_downloaded
+                        finally:
+                            # the file must not be closed under a running write, even if
+                            # receiving fails
+                            if pending_write is not None:
+                                await pending_write
+                        await asyncio.to_thread(f.write, buffer)
+                        progress.update(
+                            response.num_bytes_downloaded - num_bytes_downloaded
+                        )
     return True
 
 
-def unpack_ttc_worker(in_ttc: PathLike, index, out_file: PathLike):
+SFNT_HEADER = struct.Struct(">4sHHHH")
+TABLE_RECORD = struct.Struct(">4sLLL")
+TTC_HEADER = struct.Struct(">4sLL")
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def read_table_records(data, offset: int = 0) -> tuple[bytes, list[tuple[bytes, int, int, int]]]:
+    """
+    Read sfnt version and (tag, checksum, offset, length) table records from
+    the table directory at given offset.
+    """
+    sfnt_version, num_tables, *_ = SFNT_HEADER.unpack_from(data, offset)
+    offset += SFNT_HEADER.size
+    return sfnt_version, [
+        TABLE_RECORD.unpack_from(data, offset + i * TABLE_RECORD.size) for i in range(num_tables)
+    ]
+
+
+def copy_byte_range(src, dst, offset: int, length: int):
+    """
+    Copy a byte range of src to the current position of dst, inside the
+    kernel where sendfile() works between regular files.
+    """
+    if sys.platform == "linux":
+        while length > 0:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, length)
+            if sent == 0:
+                raise EOFError(f"{src.name} is truncated")
+            offset += sent
+            length -= sent
+    else:
+        src.seek(offset)
+        while length > 0:
+            chunk = src.read(min(length, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise EOFError(f"{src.name} is truncated")
+            length -= len(chunk)
+            # dst is unbuffered, a single write() may take only part of the chunk
+            view = memoryview(chunk)
+            while view:
+                view = view[dst.write(view):]
+
+
+def unpack_ttc_worker(in_ttc: PathLike, face_offset: int, out_file: PathLike):
+    """
+    Extract a face from a TTC by copying its tables verbatim into a new sfnt.
+    """
     print(f"  UNTTC\t{in_ttc} -> {out_file}")
-    ttc = ttLib.TTCollection(in_ttc)
-    font = ttc[index]
     ensure_parent_dir(out_file)
-    font.save(out_file)
+    with open(in_ttc, "rb") as src, open(out_file, "wb", buffering=0) as dst:
+        src.seek(face_offset)
+        directory = src.read(SFNT_HEADER.size)
+        directory += src.read(TABLE_RECORD.size * SFNT_HEADER.unpack(directory)[1])
+        sfnt_version, records = read_table_records(directory)
+
+        offset = SFNT_HEADER.size + TABLE_RECORD.size * len(records)
+        head_offset = None
+        new_records = []
+        for tag, checksum, _table_offset, length in records:
+            if tag == b"head":
+                head_offset = offset
+            new_records.append((tag, checksum, offset, length))
+            offset += (length + 3) & ~3
+        if head_offset is None:
+            raise ValueError(f"face at {face_offset} of {in_ttc} has no head table")
+        directory = SFNT_HEADER.pack(sfnt_version, len(records), *getSearchRange(len(records), 16))
+        directory += b"".join(TABLE_RECORD.pack(*record) for record in new_records)
+        dst.write(directory)
+
+        for _tag, _checksum, table_offset, length in records:
+            copy_byte_range(src, dst, table_offset, length)
+            dst.write(b"\0" * (-length % 4))
+
+        # table checksums (head's computed with a zero adjustment) sum up to the
+        # checksum of the whole file, no need to read the tables back
+        checksum = calcChecksum(directory) + sum(record[1] for record in records)
+        dst.seek(head_offset + 8)
+        dst.write(struct.pack(">L", (0xB1B0AFBA - checksum) & 0xFFFFFFFF))
+
+
+def unpack_and_process_ttf_worker(
+    in_ttc: PathLike, index: int, face_offset: int, out_ttf: PathLike, temp_dir: PathLike
+):
+    """
+    Extract a face from a TTC and process it within a single worker task, so
+    each face costs one worker start instead of two.
+    """
+    input_ttf = Path(temp_dir) / "input_ttf" / (Path(in_ttc).name + f"#{index}.ttf")
+    unpack_ttc_worker(in_ttc, face_offset, input_ttf)
+    process_ttf_worker(input_ttf, out_ttf, temp_dir)
 
 
 def pack_ttc(ttfs: list[PathLike], out_ttc: PathLike):
+    """
+    Concatenate font files into a TTC, storing identical tables only once.
+    """
     print(f"  TTC\t{out_ttc}")
-    ttc = ttLib.TTCollection()
-    for ttf in ttfs:
-        ttc.fonts.append(ttLib.TTFont(ttf))
-    ensure_parent_dir(out_ttc)
-    ttc.save(out_ttc)
+    with ExitStack() as stack:
+        fonts = []
+        for ttf in ttfs:
+            f = stack.enter_context(open(ttf, "rb"))
+            data = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            # slices of a memoryview hash and write without copying the table
+            data = stack.enter_context(memoryview(data))
+            fonts.append((data, *read_table_records(data)))
+
+        offset = TTC_HEADER.size + 4 * len(fonts)
+        directory_offsets = []
+        for _data, _sfnt_version, records in fonts:
+            directory_offsets.append(offset)
+            offset += SFNT_HEADER.size + TABLE_RECORD.size * len(records)
+
+        # lay out unique tables after all table directories, 4-byte aligned
+        table_offsets = {}
+        tables = []
+        directories = []
+        for data, sfnt_version, records in fonts:
+            directory = []
+            for tag, checksum, table_offset, length in records:
+                digest = hashlib.sha256(data[table_offset:table_offset + length]).digest()
+                if digest not in table_offsets:
+                    table_offsets[digest] = offset
+                    tables.append((data, table_offset, length))
+                    offset += (length + 3) & ~3
+                directory.append((tag, checksum, table_offsets[digest], length))
+            directories.append((sfnt_version, directory))
 
+        ensure_parent_dir(out_ttc)
+        with open(out_ttc, "wb") as f:
+            f.write(TTC_HEADER.pack(b"ttcf", 0x00010000, len(fonts)))
+            f.write(struct.pack(f">{len(fonts)}L", *directory_offsets))
+            for sfnt_version, directory in directories:
+                f.write(SFNT_HEADER.pack(sfnt_version, len(directory), *getSearchRange(len(directory), 16)))
+                for record in directory:
+                    f.write(TABLE_RECORD.pack(*record))
+            for data, table_offset, length in tables:
+                f.write(data[table_offset:table_offset + length])
+                f.write(b"\0" * (-length % 4))
 
-def is_ttc(file_path: PathLike) -> bool:
-    with open(file_path, "rb") as f:
-        return f.read(4) == b"ttcf"
+
+def read_ttc_offsets(file_path: PathLike) -> list[int] | None:
+    """
+    Read the table directory offset of each face from a TTC header.
+    Return None if the file is not a font collection.
+    """
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        header = os.read(fd, TTC_HEADER.size)
+        if header[:4] != b"ttcf":
+            return None
+        _tag, _version, num_fonts = TTC_HEADER.unpack(header)
+        return list(struct.unpack(f">{num_fonts}L", os.read(fd, 4 * num_fonts)))
+    finally:
+        os.close(fd)
 
 
 async def process_ttf(executor: Executor, in_ttf: PathLike, out_ttf: PathLike, temp_dir: PathLike):
@@ -152,28 +351,33 @@ async def process_ttf(executor: Executor, in_ttf: PathLike, out_ttf: PathLike, t
     await loop.run_in_executor(executor, process_ttf_worker, in_ttf, out_ttf, temp_dir)
 
 
-async def process_ttc(executor: Executor, in_ttc: PathLike, out_ttc: PathLike, temp_dir: PathLike):
+async def process_ttc(
+    executor: Executor, in_ttc: PathLike, out_ttc: PathLike, temp_dir: PathLike,
+    offsets: list[int] | None = None
+):
     loop = asyncio.get_event_loop()
     out_ttfs = []
-    ttc = ttLib.TTCollection(in_ttc)
-
-    async def unpack_and_process_ttf(in_ttc, index, ttf_out):
-        input_ttf = Path(temp_dir) / "input_ttf" / (Path(in_ttc).name + f"#{index}.ttf")
-        await loop.run_in_executor(executor, unpack_ttc_worker, in_ttc, index, input_ttf)
-        await process_ttf(executor, input_ttf, ttf_out, temp_dir)
+    if offsets is None:
+        offsets = read_ttc_offsets(in_ttc)
 
     coros = []
-    for i in range(len(ttc)):
+    for i, face_offset in enumerate(offsets):
         ttf_out = Path(temp_dir) / "processed_ttf" / (Path(in_ttc).name + f"#{i}.ttf")
         out_ttfs.append(ttf_out)
-        coros.append(unpack_and_process_ttf(in_ttc, i, ttf_out))
+        coros.append(loop.run_in_executor(
+            executor, unpack_and_process_ttf_worker, in_ttc, i, face_offset, ttf_out, temp_dir
+        ))
 
     await asyncio.gather(*coros)
     await loop.run_in_executor(executor, pack_ttc, out_ttfs, out_ttc)
 
 
 async def process_font(executor: Executor, in_font: PathLike, out_font: PathLike, temp_dir: PathLike):
-    if is_ttc(in_font):
-        await process_ttc(executor, in_font, out_font, temp_dir)
+    # read-ahead runs in the background while the workers start up
+    prefetch_file(in_font)
+    # the TTC header is read once here and handed over to process_ttc
+    offsets = read_ttc_offsets(in_font)
+    if offsets is not None:
+        await process_ttc(executor, in_font, out_font, temp_dir, offsets)
     else:
         await process_ttf(executor, in_font, out_font, temp_dir)
@@ -1,7 +1,10 @@
 import argparse
 import concurrent.futures
 import asyncio
+import multiprocessing
+import os
 import shutil
+import sys
 import urllib.parse
 from pathlib import Path
 
@@ -30,12 +33,27 @@ async def main():
     download_sem = asyncio.Semaphore(2)
     temp_dir = Path("temp")
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, max_tasks_per_child=1)
+    if not getattr(sys, "_is_gil_enabled", lambda: True)():
+        # free-threaded build, and no extension module re-enabled the GIL on
+        # import: run the workers as threads without any process start-up cost
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs or os.cpu_count())
+    else:
+        mp_context = None
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            # fork each single-use worker from a server process that has already
+            # imported fontTools, chws_tool and uharfbuzz, instead of spawning a
+            # fresh interpreter that imports them again for every task
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload(["chws_subset"])
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs, mp_context=mp_context, max_tasks_per_child=1
+        )
 
     async def download_and_process_file(url: str):
         base_file_name = urllib.parse.urlparse(url).path.split("/")[-1]
         input_file = temp_dir / "input" / base_file_name
-        await download_file(url, input_file, download_sem)
+        if not await download_file(url, input_file, download_sem):
+            raise RuntimeError(f"Failed to download {url}")
         await process_font(executor, input_file, Path("system/fonts") / base_file_name, temp_dir)
 
     futures = [download_and_process_file(url) for url in urls]